@@ -26,57 +26,204 @@ import json
 import logging
 import sleekxmpp
 import datetime
-import locale
 import dataset
 import configargparse
 import getpass
+import itertools
 import os
+import queue
 import random
 import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.exc
+import sqlalchemy.pool
+import sys
+import threading
 import xdg.BaseDirectory
 import pathlib
 
-locale.setlocale(locale.LC_ALL, 'fr_FR.UTF-8')
+# Shortcuts for the event handlers, which call them for almost every stanza.
+_now = datetime.datetime.now
+_choice = random.choice
 
 default_vocabulary = {
-    'help': ["My vocabulary empty, I can't help you."],
-    'empty_log': ["No log for you."],
-    'gossips': ["{nick} is reading the back log."],
-    'greetings': ["/me is here!"],
-    'insults': ['If I had vocabulary, I would insult {nick}.'],
-    'uptime': ["I'm up for {uptime}."],
-    'welcome': ["{nick}'s last connection: {date}."],
+    'help': ("My vocabulary empty, I can't help you.",),
+    'empty_log': ("No log for you.",),
+    'gossips': ("{nick} is reading the back log.",),
+    'greetings': ("/me is here!",),
+    'insults': ('If I had vocabulary, I would insult {nick}.',),
+    'uptime': ("I'm up for {uptime}.",),
+    'welcome': ("{nick}'s last connection: {date}.",),
     # Responses to direct messages (not on a MUC):
-    'refusals': ["I don't accept direct messages. Try on a MUC."],
+    'refusals': ("I don't accept direct messages. Try on a MUC.",),
 }
 
+# MUC messages are buffered and written to the database in a single
+# transaction, either every `log_flush_interval` seconds or as soon as
+# `log_flush_size` messages are pending, whichever comes first.
+log_flush_interval = 2
+log_flush_size = 50
+
+# Ditto for the users' timestamps, which are updated on every presence change:
+# changes are written every `user_flush_interval` seconds.
+user_flush_interval = 1
+
+# Maximum size in bytes (UTF-8 encoded) of a message body sent by the bot.
+# Longer texts (e.g. backlogs) are split over several messages, to stay under
+# the stanza size limit of most servers.
+max_message_length = 8000
+
+# Format of the dates sent to the users. Only numeric fields are used, so that
+# formatting doesn't depend on (nor look up) the locale.
+date_format = '%d/%m/%Y %H:%M'
+
+# When the log is pruned (log retention set or --keep_log off), old MUC messages
+# are deleted every `prune_log_interval` seconds.
+prune_log_interval = 60 * 60
+
+# With --keep_log off, the users who left more than `backlog_max_age` days ago
+# don't keep the messages they missed from being deleted.
+backlog_max_age = 30
+
+# SQLite settings suited to an append-mostly log: the write-ahead log lets
+# readers work during writes, and with it synchronous=NORMAL stays crash-safe
+# while syncing the disk less often than the default (FULL).
+sqlite_pragmas = (
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'temp_store=MEMORY',
+    'cache_size=-20000',  # 20 MB
+    'mmap_size=268435456',  # 256 MB
+    'journal_size_limit=67108864',  # 64 MB, WAL file truncated to that
+)
+
 
 class KaaBot(sleekxmpp.ClientXMPP):
     def __init__(self, jid, password, database, muc, nick, vocabulary_file,
-                 welcome):
+                 welcome, log_retention=0, fast_db=True, keep_log=True):
         sleekxmpp.ClientXMPP.__init__(self, jid, password)
 
         self.muc = muc
-        self.nick = nick
+        self.nick = sys.intern(nick)
         self.online_timestamp = None
         database_path = self.find_database(database, muc)
+        # All the database work is done by the database thread through a
+        # single connection. Writes wait up to `timeout` seconds for another
+        # process holding a lock on the database.
         self.db = dataset.connect('sqlite:///{db}'.format(db=database_path),
-                                  engine_kwargs={'connect_args': {
-                                      'check_same_thread': False}})
+                                  engine_kwargs={
+                                      'poolclass': sqlalchemy.pool.StaticPool,
+                                      'connect_args': {
+                                          'check_same_thread': False,
+                                          'timeout': 30}})
+        if fast_db:
+            self.tune_database(database_path)
 
         self.vocabulary = self.init_vocabulary(vocabulary_file)
+        self.help_mbody = '\n  '.join(self.vocabulary['help'])
 
         self.welcome = welcome
+        self.log_retention = log_retention
+        self.keep_log = keep_log
 
         self.users = self.db['user']
         # Initialize table with correct type.
         self.users.create_column('nick', sqlalchemy.String)
         self.users.create_column('offline_timestamp', sqlalchemy.DateTime)
         self.users.create_column('online_timestamp', sqlalchemy.DateTime)
+        # Nicks are unique, which allows writing users with a single UPSERT.
+        # Older versions could create duplicates, in which case only the first
+        # row of each nick (the one the bot used to read) is kept.
+        create_nick_index = ('CREATE UNIQUE INDEX IF NOT EXISTS '
+                             'idx_user_nick ON user (nick)')
+        try:
+            self.db.executable.execute(create_nick_index)
+        except sqlalchemy.exc.IntegrityError:
+            logging.warning('Removing duplicate users from the database.')
+            self.db.executable.execute('DELETE FROM user WHERE id NOT IN '
+                                       '(SELECT MIN(id) FROM user '
+                                       'GROUP BY nick)')
+            self.db.executable.execute(create_nick_index)
+        # Load all the users with a single query rather than one per nick
+        # when the bot joins the MUC.
+        self.user_cache = {user['nick']: user for user in self.users.all()}
 
         self.muc_log = self.db['muc_log']
+        self.muc_log.create_column('datetime', sqlalchemy.DateTime)
+        self.muc_log.create_column('msg', sqlalchemy.UnicodeText)
+        self.muc_log.create_column('user', sqlalchemy.UnicodeText)
+        # Speeds up the backlog lookups done by send_log(). Table.create_index()
+        # is not used because it silently ignores any error, including the
+        # index already existing.
+        self.db.executable.execute('CREATE INDEX IF NOT EXISTS '
+                                   'idx_muc_log_datetime ON muc_log (datetime)')
+
+        # The statements of the hot paths are built once and executed directly,
+        # rather than letting dataset check the columns and build them again
+        # on every call. dataset is still used to manage the schema.
+        log = self.muc_log.table
+        self.user_upsert = sqlalchemy.text(
+            'INSERT INTO user (nick, online_timestamp, offline_timestamp) '
+            'VALUES (:nick, :online_timestamp, :offline_timestamp) '
+            'ON CONFLICT (nick) DO UPDATE SET '
+            'online_timestamp = excluded.online_timestamp, '
+            'offline_timestamp = excluded.offline_timestamp'
+        ).bindparams(
+            sqlalchemy.bindparam('online_timestamp',
+                                 type_=sqlalchemy.DateTime),
+            sqlalchemy.bindparam('offline_timestamp',
+                                 type_=sqlalchemy.DateTime))
+        # This one is even compiled in advance, since it runs for every batch
+        # of MUC messages.
+        self.muc_log_insert = log.insert().compile(
+            self.db.engine, column_keys=['datetime', 'msg', 'user'])
+        self.backlog_select = sqlalchemy \
+            .select([log.c.datetime, log.c.user, log.c.msg]) \
+            .where(log.c.datetime > sqlalchemy.bindparam('since')) \
+            .where(log.c.datetime < sqlalchemy.bindparam('until')) \
+            .order_by(log.c.datetime)
+
+        # All the database work after this point is done by a dedicated
+        # thread (see db_worker()), so that XMPP events are never blocked by
+        # SQLite.
+        self.db_queue = queue.Queue()
+        self.db_thread = threading.Thread(target=self.db_worker, daemon=True)
+        self.db_thread.start()
+
+        self.log_buffer = []
+        # Users whose cached row changed since the last flush_users(), by nick.
+        self.pending_users = {}
+        # Protects log_buffer and pending_users, which are flushed from the
+        # scheduler, from event handlers and from the main thread on exit.
+        self.buffer_lock = threading.Lock()
+        self.schedule('flush_log', log_flush_interval, self.flush_log,
+                      repeat=True)
+        self.schedule('flush_users', user_flush_interval, self.flush_users,
+                      repeat=True)
+        if log_retention or not keep_log:
+            self.run_db(self.prune_log)
+            self.schedule('prune_log', prune_log_interval, self.run_db,
+                          args=(self.prune_log,), repeat=True)
+
+        # Commands understood by the bot. Handlers are called with the nick
+        # and JID of the sender, and whether the command was sent privately.
+        self.commands = {
+            '': self.send_help,  # original message was just the bot's name
+            'log': self.send_log,
+            'histo': self.send_log,
+            'help': self.send_help,
+            'aide': self.send_help,
+            'uptime': self.send_uptime,
+        }
+
+        # MUC (the muc:: events below depend on it), XHTML-IM and user nick.
+        self.register_plugin('xep_0045')
+        self.register_plugin('xep_0071')
+        self.register_plugin('xep_0172')
 
         self.add_event_handler("session_start", self.session_start)
+        self.add_event_handler("disconnected", self.flush_log)
+        self.add_event_handler("disconnected", self.flush_users)
         self.add_event_handler("message", self.message)
         self.add_event_handler("muc::%s::got_online" % self.muc,
                                self.muc_online)
@@ -105,6 +252,22 @@ class KaaBot(sleekxmpp.ClientXMPP):
         database = "{muc}.db".format(muc=muc)
         return os.path.join(data_dir, database)
 
+    def tune_database(self, database_path):
+        """Applies `sqlite_pragmas` to the database connections.
+        """
+        # The pragmas are set on every new connection of the pool; the one
+        # dataset opened to reflect the tables is closed to go through it.
+        sqlalchemy.event.listen(self.db.engine, 'connect',
+                                set_sqlite_pragmas)
+        self.db.engine.dispose()
+        # SQLite silently keeps the old journal mode if WAL is not supported
+        # (e.g. on some network file systems).
+        journal_mode = self.db.executable.execute(
+            'PRAGMA journal_mode').scalar()
+        if journal_mode.lower() != 'wal':
+            logging.warning("Can't enable WAL on database %s, journal mode "
+                            "is '%s'.", database_path, journal_mode)
+
     @staticmethod
     def init_vocabulary(vocabulary_file):
         """Reads the vocabulary from a JSON file.
@@ -145,17 +308,16 @@ class KaaBot(sleekxmpp.ClientXMPP):
         try:
             fd = open(vocabulary_file, encoding='UTF-8')
         except IOError:
-            logging.error("Can't open vocabulary file {filename}!"
-                          .format(filename=vocabulary_file))
+            logging.error("Can't open vocabulary file %s!", vocabulary_file)
             raise
 
         try:
-            vocabulary = json.load(fd)
+            vocabulary = {category: tuple(sentences) for category, sentences
+                          in json.load(fd).items()}
             fd.close()
         except ValueError:  # json.JSONDecodeError in Python >= 3.5
-            logging.warning(("Invalid JSON vocabulary file '{filename}'. "
-                             "Minimal vocabulary will be set.")
-                            .format(filename=vocabulary_file))
+            logging.warning("Invalid JSON vocabulary file '%s'. "
+                            "Minimal vocabulary will be set.", vocabulary_file)
             vocabulary = default_vocabulary
 
         return vocabulary
@@ -169,50 +331,204 @@ class KaaBot(sleekxmpp.ClientXMPP):
     def message(self, msg):
         """Handles incoming messages.
         """
+        # Stanza fields are looked up only once, as each access goes through
+        # sleekxmpp's stanza interfaces.
+        mtype = msg['type']
+        dest = msg['from']
+
         # Private message
-        if msg['type'] in ('chat', 'normal'):
+        if mtype in ('chat', 'normal'):
             # Don't accept private messages unless they are initiated from a MUC
-            if msg['from'].bare != self.muc:
+            if dest.bare != self.muc:
                 msg.reply(self.pick_sentence('refusals')).send()
                 return
 
             # Message's author info
-            dest = msg['from']
-            nick = msg['from'].resource
+            nick = dest.resource
 
             command = msg['body'].strip()
             self.parse_command(command, nick, dest, priv=True)
 
         # Public (MUC) message
-        elif msg['type'] in ('groupchat'):
-            # Message's author info
-            dest = msg['from']
-            nick = msg['mucnick']
+        elif mtype == 'groupchat':
+            # Message's author info. Nicks are interned so that comparing them
+            # is cheap.
+            nick = sys.intern(msg['mucnick'])
+
+            # Stop dealing with this message if we sent it (it's not logged
+            # either)
+            if nick is self.nick:
+                return
+
+            body = msg['body']
+            now = _now()
+
+            # Buffer message with timestamp, it will be inserted in database
+            # by flush_log()
+            with self.buffer_lock:
+                self.log_buffer.append(dict(datetime=now, msg=body, user=nick))
+                buffer_full = len(self.log_buffer) >= log_flush_size
+            if buffer_full:
+                self.flush_log()
+
+            # The body is scanned only once for the bot's nick.
+            before, found, after = body.partition(self.nick)
+            if not found:
+                return
+
+            if after:
+                # Bot's nick is at the beginning (or in the middle)
+                command = after
+            else:
+                # Bot's nick is at the end
+                command = before
+            command = command.lstrip('\t :, ').rstrip()
+            self.parse_command(command, nick, dest)
+
+    def run_db(self, function, *args):
+        """Queues a call to function(*args) in the database thread.
 
-            # Insert message in database with timestamp
-            self.muc_log.insert(dict(datetime=datetime.datetime.now(),
-                                     msg=msg['body'], user=nick))
+        Calls are run in the order they were queued.
+        """
+        self.db_queue.put((function, args))
+
+    def db_worker(self):
+        """Runs the calls queued by run_db(), until None is queued.
 
-            # Stop dealing with this message if we sent it
-            if msg['mucnick'] == self.nick:
+        All the calls queued at a given time are run in a single transaction.
+        An exception raised by a call is logged and doesn't prevent the other
+        calls from being committed; the rows that call was writing are lost.
+        If the transaction itself fails (e.g. the database stays locked), the
+        rows written by the whole batch are put back in the buffers, to be
+        written again by the next flushes.
+        """
+        while True:
+            jobs = [self.db_queue.get()]
+            while True:
+                try:
+                    jobs.append(self.db_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with self.db:
+                    for job in jobs:
+                        if job is None:
+                            continue
+                        function, args = job
+                        try:
+                            function(*args)
+                        except Exception:
+                            logging.exception('KaaBot : Database error in %s',
+                                              function.__name__)
+            except Exception:
+                logging.exception('KaaBot : Database transaction failed')
+                self.restore_writes(jobs)
+
+            if None in jobs:
                 return
 
-            splitbody = msg['body'].split(sep=self.nick, maxsplit=1)
+    def restore_writes(self, jobs):
+        """Puts the rows of the write_log() and write_users() calls in the list
+        `jobs` back in the buffers.
+        """
+        with self.buffer_lock:
+            for job in jobs:
+                if job is None:
+                    continue
+                function, args = job
+                if function == self.write_log:
+                    # Older than the buffered messages, which follow them.
+                    self.log_buffer[:0] = args[0]
+                elif function == self.write_users:
+                    # Pending rows are the cached ones, never older.
+                    for nick, user in args[0].items():
+                        self.pending_users.setdefault(nick, user)
+
+    def close_db(self):
+        """Writes all the pending changes and stops the database thread.
+        """
+        self.flush_log()
+        self.flush_users()
+        self.db_queue.put(None)
+        self.db_thread.join()
+
+    def flush_log(self, event=None):
+        """Writes the buffered MUC messages to the database.
+
+        All the pending messages are inserted in a single transaction, so that
+        SQLite syncs the disk once per batch instead of once per message.
+        `event` is ignored; it allows this method to be used as an event
+        handler.
+        """
+        with self.buffer_lock:
+            rows, self.log_buffer = self.log_buffer, []
+        if rows:
+            self.run_db(self.write_log, rows)
+
+    def write_log(self, rows):
+        """Inserts `rows` in the MUC log (database thread only).
+        """
+        self.db.executable.execute(self.muc_log_insert, rows)
 
-            # The message starts or ends with the bot's nick
-            if len(splitbody) == 2:
-                if splitbody[1]:
-                    # Bot's nick is at the beginning
-                    command = splitbody[1]
-                else:
-                    # Bot's nick is at the end
-                    command = splitbody[0]
-                command = command.lstrip('\t :, ').rstrip()
-                self.parse_command(command, nick, dest)
+    def flush_users(self, event=None):
+        """Writes the pending changes of user rows to the database.
 
-            # The bot's nick was used in the middle of a message
-            elif self.nick in msg['body']:
-                self.send_insult(nick, dest.bare)
+        The presence handlers only update the cached rows; all the changes are
+        written here in a single transaction. `event` is ignored; it allows
+        this method to be used as an event handler.
+        """
+        with self.buffer_lock:
+            users, self.pending_users = self.pending_users, {}
+        if users:
+            self.run_db(self.write_users, users)
+
+    def write_users(self, users):
+        """Writes the rows of the dict `users`, indexed by nick (database
+        thread only).
+        """
+        rows = [dict(nick=nick,
+                     online_timestamp=user['online_timestamp'],
+                     offline_timestamp=user['offline_timestamp'])
+                for nick, user in users.items()]
+        self.db.executable.execute(self.user_upsert, rows)
+
+    def prune_log(self):
+        """Deletes the MUC messages that are not needed anymore (database
+        thread only).
+
+        If `log_retention` is set, the messages older than that many days are
+        deleted.
+
+        If `keep_log` is False, the messages that are part of no backlog are
+        deleted as well. A backlog only contains messages posted after the
+        user's offline timestamp, so the messages older than the oldest offline
+        timestamp are never sent again. The users who left more than
+        `backlog_max_age` days ago are not taken into account.
+
+        Keeping the log table small keeps its index in memory and the backlog
+        lookups fast. The freed pages are reused by the next inserts.
+        """
+        now = _now()
+        cutoffs = []
+        if self.log_retention:
+            cutoffs.append(now - datetime.timedelta(days=self.log_retention))
+        if not self.keep_log:
+            oldest = now - datetime.timedelta(days=backlog_max_age)
+            with self.buffer_lock:
+                offline_timestamps = [user['offline_timestamp']
+                                      for user in self.user_cache.values()
+                                      if user['offline_timestamp'] and
+                                      user['offline_timestamp'] > oldest]
+            cutoffs.append(min(offline_timestamps, default=oldest))
+        if not cutoffs:
+            return
+        cutoff = max(cutoffs)
+        log = self.muc_log.table
+        result = self.db.executable.execute(
+            log.delete().where(log.c.datetime < cutoff))
+        logging.debug('KaaBot : %d messages older than %s deleted.',
+                      result.rowcount, cutoff)
 
     def parse_command(self, command, nick, dest, priv=False):
         """Parses a command sent by dest (nick).
@@ -221,23 +537,17 @@ class KaaBot(sleekxmpp.ClientXMPP):
         message, False if analysing a public message. In any case, the bot may
         report publicly information about the commands processed.
         """
-        if not command:  # original message was just the bot's name
-            self.send_help(dest)
-        elif command in ['log', 'histo']:
-            self.send_log(nick, dest, echo=priv)
-        elif command in ['help', 'aide']:
-            self.send_help(dest)
-        elif command in ['uptime']:
-            self.send_uptime(dest, priv)
+        handler = self.commands.get(command)
+        if handler:
+            handler(nick, dest, priv)
         else:
             self.send_insult(nick, dest.bare)
 
-    def send_help(self, dest):
+    def send_help(self, nick, dest, priv=False):
         """Sends help messages to 'dest'.
         """
-        mbody = '\n  '.join(self.vocabulary['help'])
         self.send_message(mto=dest,
-                          mbody=mbody,
+                          mbody=self.help_mbody,
                           mtype='chat')
 
     def send_log(self, nick, dest, echo=False):
@@ -249,45 +559,72 @@ class KaaBot(sleekxmpp.ClientXMPP):
                               mbody=gossip,
                               mtype='groupchat')
 
-        # Get offline timestamp from database and check if it exists.
-        offline_timestamp = self.users.find_one(nick=nick)['offline_timestamp']
+        # Get timestamps from database and check if the offline one exists.
+        # The user may also be unknown, e.g. if the command was sent privately
+        # before the bot got their presence.
+        user = self.get_user(nick)
+        if user is None:
+            offline_timestamp = online_timestamp = None
+        else:
+            offline_timestamp = user['offline_timestamp']
+            online_timestamp = user['online_timestamp']
         if not offline_timestamp:
-            logging.debug(('KaaBot : No offline'
-                           ' timestamp for {nick}.').format(nick=nick))
+            logging.debug('KaaBot : No offline timestamp for %s.', nick)
             self.send_empty_log(dest)
             return
         else:
-            logging.debug(
-                ('KaaBot : {nick} '
-                 'last seen on {date}').format(nick=nick,
-                                               date=offline_timestamp))
-
-        # Get online timestamp from database.
-        online_timestamp = self.users.find_one(nick=nick)['online_timestamp']
-        logging.debug(('KaaBot : {nick} last'
-                       ' connection on {date}').format(nick=nick,
-                                                       date=online_timestamp))
-
-        # Since filtered log is a generator we can't know in advance if
-        # it will be empty. Creating filtered_log_empty allows us to act on
-        # this event later.
-        filtered_log_empty = True
-        filtered_log = (log for log in self.muc_log if
-                        offline_timestamp < log['datetime'] < online_timestamp)
-
-        for log in filtered_log:
-            filtered_log_empty = False
-            log_message = "[{:%H:%M}] {}: {}".format(log['datetime'],
-                                                     log['user'],
-                                                     log['msg'])
-            self.send_message(mto=dest,
-                              mbody=log_message,
-                              mtype='chat')
+            logging.debug('KaaBot : %s last seen on %s', nick,
+                          offline_timestamp)
+
+        logging.debug('KaaBot : %s last connection on %s', nick,
+                      online_timestamp)
+
+        # The buffered messages are queued before the lookup, so that the
+        # backlog includes them.
+        self.flush_log()
+        self.run_db(self.send_backlog, dest, offline_timestamp,
+                    online_timestamp)
 
-        # Send message if filtered_log is still empty.
-        if filtered_log_empty:
+    def send_backlog(self, dest, since, until):
+        """Sends to 'dest' the messages logged between `since` and `until`
+        (database thread only).
+        """
+        # Rows are fetched as plain tuples, without dataset's dict conversion.
+        filtered_log = self.db.executable.execute(self.backlog_select,
+                                                  since=since, until=until)
+
+        # The first row tells if the backlog is empty, without a separate
+        # COUNT query or scanning it all.
+        first_log = filtered_log.fetchone()
+        if first_log is None:
             logging.debug('KaaBot : Filtered backlog empty.')
             self.send_empty_log(dest)
+            return
+
+        # Lines are grouped in as few messages as possible instead of being
+        # sent one by one.
+        lines = []
+        length = 0
+        format_log = "[{:%H:%M}] {}: {}".format
+        for log_datetime, author, msg in itertools.chain([first_log],
+                                                         filtered_log):
+            log_message = format_log(log_datetime, author, msg)
+            size = len(log_message.encode('UTF-8'))
+            if lines and length + size > max_message_length:
+                self.send_lines(dest, lines)
+                lines = []
+                length = 0
+            lines.append(log_message)
+            length += size + 1
+        if lines:
+            self.send_lines(dest, lines)
+
+    def send_lines(self, dest, lines):
+        """Sends the list of strings `lines` to 'dest' in a single message.
+        """
+        self.send_message(mto=dest,
+                          mbody='\n'.join(lines),
+                          mtype='chat')
 
     def send_empty_log(self, dest):
         """Send message if backlog empty.
@@ -297,13 +634,13 @@ class KaaBot(sleekxmpp.ClientXMPP):
                           mbody=mbody,
                           mtype='chat')
 
-    def send_uptime(self, dest, priv=False):
+    def send_uptime(self, nick, dest, priv=False):
         """Sends the uptime to `dest`.
 
         If `priv` is true, the message is sent privately, otherwise it's send on
         the MUC.
         """
-        uptime = str(datetime.datetime.now() - self.online_timestamp)
+        uptime = str(_now() - self.online_timestamp)
         mbody = self.pick_sentence('uptime').format(uptime=uptime)
         if priv:
             self.send_message(mto=dest,
@@ -328,54 +665,54 @@ class KaaBot(sleekxmpp.ClientXMPP):
                           mbody=msg,
                           mtype='groupchat')
 
-    def pick_sentence(self, type):
+    def pick_sentence(self, category):
         """Returns a random sentence picked in the loaded vocabulary.
 
-        `type` can be any known category of the vocabulary file, e.g. 'insults'.
-        No substitution is done to the returned string.
+        `category` can be any known category of the vocabulary file, e.g.
+        'insults'. No substitution is done to the returned string.
         """
-        voc = self.vocabulary[type]
-        i = random.randint(0, len(voc) - 1)
-        return voc[i]
+        return _choice(self.vocabulary[category])
 
     def muc_online(self, presence):
         """Handles MUC online presence.
            On bot connection gets called for each
            user in the MUC (bot included).
         """
+        # Stanza fields are looked up only once.
         nick = presence['muc']['nick']
+        dest = presence['from'].bare
+        now = _now()
         if nick != self.nick:
             # Check if nick in database.
-            if self.users.find_one(nick=nick):
+            user = self.get_user(nick)
+            if user:
 
                 # Update nick online timestamp.
-                self.users.update(dict(nick=nick,
-                                       online_timestamp=datetime.datetime.now()),
-                                  ['nick'])
+                self.update_user(user, online_timestamp=now)
 
                 # Check if bot is connecting for the first time.
                 if self.online_timestamp:
-                    try:
-                        user = self.users.find_one(nick=nick)
-                        offline_timestamp = user['offline_timestamp']
-                        date = datetime.datetime.strftime(offline_timestamp,
-                                                          format="%c")
-                        logging.debug('KaaBot : user {} connected, last seen {}'
-                                      .format(nick, date))
+                    offline_timestamp = user['offline_timestamp']
+                    if offline_timestamp:
+                        # The timestamp is only formatted for humans if it's
+                        # actually sent.
+                        logging.debug('KaaBot : user %s connected, '
+                                      'last seen %s', nick, offline_timestamp)
                         if self.welcome:
-                            dest = presence['from'].bare
+                            date = offline_timestamp.strftime(date_format)
                             self.send_welcome(nick, dest, date)
-
-                    except TypeError:
-                        msg = 'KaaBot : No offline timestamp yet for {nick}'
-                        logging.debug(msg.format(nick=nick))
+                    else:
+                        logging.debug('KaaBot : No offline timestamp yet '
+                                      'for %s', nick)
             else:
-                self.users.insert(dict(nick=nick,
-                                       online_timestamp=datetime.datetime.now()))
+                user = dict(nick=nick,
+                            online_timestamp=now,
+                            offline_timestamp=None)
+                self.update_user(user)
         else:
             # Set bot online timestamp.
-            self.online_timestamp = datetime.datetime.now()
-            self.send_message(mto=presence['from'].bare,
+            self.online_timestamp = now
+            self.send_message(mto=dest,
                               mbody=self.pick_sentence('greetings'),
                               mtype='groupchat')
 
@@ -383,10 +720,46 @@ class KaaBot(sleekxmpp.ClientXMPP):
         """Handles MUC offline presence.
         """
         nick = presence['muc']['nick']
+        now = _now()
         if nick != self.nick:
-            self.users.update(dict(nick=nick,
-                                   offline_timestamp=datetime.datetime.now()),
-                              ['nick'])
+            user = self.get_user(nick)
+            # The cache holds every row, so an unknown nick has nothing to
+            # update in the database either.
+            if user is None:
+                return
+            self.update_user(user, offline_timestamp=now)
+            # The messages logged until the user left are written along with
+            # their offline timestamp, without waiting for the next flush.
+            self.flush_log()
+            self.flush_users()
+
+    def get_user(self, nick):
+        """Returns the database row of the user `nick`, or None if unknown.
+
+        All the rows are loaded in memory at startup, so the database is never
+        queried. The cached rows must only be modified through update_user().
+        """
+        return self.user_cache.get(nick)
+
+    def update_user(self, user, **fields):
+        """Sets `fields` in the (new or cached) row `user`.
+
+        The change is visible immediately through get_user(), and is written
+        to the database by the next flush_users().
+        """
+        user.update(fields)
+        with self.buffer_lock:
+            self.user_cache[user['nick']] = user
+            self.pending_users[user['nick']] = user
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Applies `sqlite_pragmas` to a new SQLite connection.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlite_pragmas:
+        cursor.execute('PRAGMA ' + pragma)
+    cursor.close()
 
 
 def str_to_bool(text):
@@ -402,6 +775,17 @@ def str_to_bool(text):
     raise TypeError
 
 
+def non_negative_int(text):
+    """Converts a string to an integer greater than or equal to zero.
+
+    Raises an exception if the string does not describe such an integer.
+    """
+    value = int(text)
+    if value < 0:
+        raise ValueError
+    return value
+
+
 if __name__ == '__main__':
 
     config_dir = xdg.BaseDirectory.save_config_path("kaabot")
@@ -429,6 +813,19 @@ if __name__ == '__main__':
     argp.add_argument("--welcome", dest="welcome", default="on",
                       type=str_to_bool,
                       help="welcome users joining the MUC (on/off, default: on)")
+    argp.add_argument("--log_retention", dest="log_retention", default=0,
+                      type=non_negative_int, metavar="DAYS",
+                      help="delete logged messages after DAYS days, even if "
+                           "they are part of a backlog (default: 0, never)")
+    argp.add_argument("--keep_log", dest="keep_log", default="on",
+                      type=str_to_bool,
+                      help="keep the logged messages that are part of no "
+                           "backlog of the last {} days (on/off, default: "
+                           "on)".format(backlog_max_age))
+    argp.add_argument("--fast_db", dest="fast_db", default="on",
+                      type=str_to_bool,
+                      help="tune SQLite for speed: write-ahead log, fewer disk "
+                           "syncs, bigger cache (on/off, default: on)")
 
     args = argp.parse_args()
 
@@ -454,9 +851,8 @@ if __name__ == '__main__':
 
     bot = KaaBot(args.jid, args.password, args.database,
                  args.muc, args.nick, args.vocabulary_file,
-                 args.welcome)
-    bot.register_plugin('xep_0045')
-    bot.register_plugin('xep_0071')
-    bot.register_plugin('xep_0172')
+                 args.welcome, args.log_retention, args.fast_db,
+                 args.keep_log)
     bot.connect()
     bot.process(block=True)
+    bot.close_db()